@@ -4,13 +4,35 @@ Mac Setup Script
 Automates the setup of a new Mac with development tools and personal configurations.
 """
 
+import argparse
+import asyncio
+import atexit
+import collections
+import filecmp
+import functools
+import hashlib
+import http.client
+import inspect
 import os
+import plistlib
+import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import xml.parsers.expat
+import xml.sax.saxutils
 import json
 import shutil
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Optional, Set, Tuple
+
+try:
+    import tomllib  # Python 3.11+
+except ImportError:
+    tomllib = None
 
 
 class Colors:
@@ -20,32 +42,192 @@ class Colors:
     YELLOW = '\033[1;33m'
     BLUE = '\033[0;34m'
     NC = '\033[0m'  # No Color
+    
+    @classmethod
+    def disable(cls) -> None:
+        """Turn off colors, e.g. when output is piped to a file."""
+        cls.RED = cls.GREEN = cls.YELLOW = cls.BLUE = cls.NC = ''
+
+
+_which_hits: Dict[Tuple[str, Optional[str]], str] = {}
+
+
+def _which(command: str, path: Optional[str]) -> Optional[str]:
+    """Locate a command on the given PATH, memoizing hits per (command, PATH).
+    
+    Misses aren't cached: an installer can add a binary to a directory that is
+    already on PATH (e.g. /usr/local/bin on Intel Macs) without changing PATH.
+    """
+    key = (command, path)
+    if key not in _which_hits:
+        location = shutil.which(command, path=path)
+        if location is None:
+            return None
+        _which_hits[key] = location
+    return _which_hits[key]
+
+
+def cached_step(key: str, title: str, inputs: Callable[['MacSetup'], Any]) -> Callable:
+    """Skip a setup step that already completed with the same inputs on a previous run.
+    
+    The inputs are fingerprinted again after the step runs, so effects of the step
+    itself (e.g. a directory it creates) don't invalidate the next run. The step is
+    recorded as done unless it raises or returns False. A skipped step still prints
+    its title as a step header, so it can be told apart from concurrent steps.
+    """
+    def decorator(func: Callable) -> Callable:
+        def fingerprint(self: 'MacSetup') -> str:
+            data = json.dumps(inputs(self), sort_keys=True, default=str)
+            return hashlib.sha256(data.encode()).hexdigest()
+            
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(self: 'MacSetup', *args, **kwargs):
+                digest = fingerprint(self)
+                if self._state.get(key) == digest:
+                    self.print_step(title)
+                    self.print_success("Unchanged since last run, skipping")
+                    return None
+                result = await func(self, *args, **kwargs)
+                if result is not False:
+                    self._state[key] = fingerprint(self)
+                return result
+            return async_wrapper
+            
+        @functools.wraps(func)
+        def wrapper(self: 'MacSetup', *args, **kwargs):
+            digest = fingerprint(self)
+            if self._state.get(key) == digest:
+                self.print_step(title)
+                self.print_success("Unchanged since last run, skipping")
+                return None
+            result = func(self, *args, **kwargs)
+            if result is not False:
+                self._state[key] = fingerprint(self)
+            return result
+        return wrapper
+    return decorator
 
 
 class MacSetup:
     """Main setup class for Mac configuration."""
     
-    def __init__(self):
+    # CLI tools
+    CLI_TOOLS = [
+        'git', 'wget', 'gcc', 'python@3.12', 'node', 'npm'
+    ]
+    
+    # Applications
+    CASK_APPS = [
+        'visual-studio-code', 'firefox', 'ghostty', 'notion', 
+        'slack', '1password', 'docker', 'zoom',
+        'raycast', 'nikitabobko/tap/aerospace'
+    ]
+    
+    ZSH_PLUGINS = {
+        'zsh-autosuggestions': 'https://github.com/zsh-users/zsh-autosuggestions',
+        'zsh-syntax-highlighting': 'https://github.com/zsh-users/zsh-syntax-highlighting',
+        'zsh-completions': 'https://github.com/zsh-users/zsh-completions'
+    }
+    
+    # Applications to add to Dock (in order)
+    DOCK_APPS = [
+        '/Applications/Visual Studio Code.app',
+        '/Applications/Slack.app', 
+        '/Applications/Firefox.app'
+    ]
+    
+    # Files in dotfiles/ that are never linked into the home directory
+    IGNORED_DOTFILES = {'.DS_Store'}
+    
+    # hidutil mapping of Caps Lock (0x700000039) to Escape (0x700000029)
+    CAPS_LOCK_TO_ESCAPE = {
+        'UserKeyMapping': [{
+            'HIDKeyboardModifierMappingSrc': 0x700000039,
+            'HIDKeyboardModifierMappingDst': 0x700000029
+        }]
+    }
+    
+    # Seconds before a download without progress is abandoned
+    DOWNLOAD_TIMEOUT = 30
+    
+    # Seconds a cached installer script is reused before downloading it again
+    INSTALLER_MAX_AGE = 24 * 60 * 60
+    
+    # Lines of streamed output kept for error reporting
+    STREAM_TAIL_LINES = 50
+    
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
         self.home = Path.home()
+        self.config = dict(config or {})
+        self.ssh_key_path = self.home / '.ssh' / 'id_ed25519'
+        self.dotfiles_dir = Path(__file__).parent / 'dotfiles'
+        self.plugins_dir = self.home / '.oh-my-zsh' / 'custom' / 'plugins'
+        self.key_remapping_plist = self.home / 'Library' / 'LaunchAgents' / 'com.local.KeyRemapping.plist'
+        self.cache_dir = self.home / '.cache' / 'mac-setup'
+        self.state_path = self.cache_dir / 'state.json'
+        self._state = self._load_state()
+        atexit.register(self._save_state)
+        self._installed_formulae: Optional[Set[str]] = None
+        self._installed_casks: Optional[Set[str]] = None
+        self._pending_restarts: Set[str] = set()
+        self._public_key: Optional[str] = None
+        self._sudo_ready: Optional[bool] = None
+        
+        # Built once from Colors, which main() may have disabled
+        self._step_prefix = f"\n{Colors.BLUE}==> "
+        self._success_prefix = f"{Colors.GREEN}✓ "
+        self._warning_prefix = f"{Colors.YELLOW}⚠ "
+        self._error_prefix = f"{Colors.RED}✗ "
+        self._line_end = f"{Colors.NC}\n"
+        
+    def _load_state(self) -> Dict[str, str]:
+        """Load the steps completed on previous runs."""
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+            
+    def _save_state(self) -> None:
+        """Persist the completed steps for the next run."""
+        try:
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.state_path, 'w') as f:
+                json.dump(self._state, f, indent=2)
+        except OSError as e:
+            self.print_warning(f"Could not save setup state: {e}")
+            
+    def _emit(self, prefix: str, message: str) -> None:
+        """Write a prefixed, colored line in a single call."""
+        sys.stdout.write(prefix + message + self._line_end)
         
     def print_step(self, message: str) -> None:
         """Print a step message in blue."""
-        print(f"\n{Colors.BLUE}==> {message}{Colors.NC}")
+        self._emit(self._step_prefix, message)
         
     def print_success(self, message: str) -> None:
         """Print a success message in green."""
-        print(f"{Colors.GREEN}✓ {message}{Colors.NC}")
+        self._emit(self._success_prefix, message)
         
     def print_warning(self, message: str) -> None:
         """Print a warning message in yellow."""
-        print(f"{Colors.YELLOW}⚠ {message}{Colors.NC}")
+        self._emit(self._warning_prefix, message)
         
     def print_error(self, message: str) -> None:
         """Print an error message in red."""
-        print(f"{Colors.RED}✗ {message}{Colors.NC}")
+        self._emit(self._error_prefix, message)
+        
+    def run_command(self, command: List[str], check: bool = True, shell: bool = False,
+                    stream: bool = False) -> subprocess.CompletedProcess:
+        """Run a shell command and return the result.
         
-    def run_command(self, command: List[str], check: bool = True, shell: bool = False) -> subprocess.CompletedProcess:
-        """Run a shell command and return the result."""
+        With stream=True the output is forwarded to the terminal as it arrives instead of
+        being buffered, and only its last lines are kept (as stdout) for error reporting.
+        """
+        if stream:
+            return self._run_streaming(command, check, shell)
+            
         try:
             if shell:
                 result = subprocess.run(command, shell=True, check=check, capture_output=True, text=True)
@@ -59,14 +241,90 @@ class MacSetup:
                 raise
             return e
             
+    def _run_streaming(self, command: List[str], check: bool, shell: bool) -> subprocess.CompletedProcess:
+        """Run a command, echoing its combined output line by line."""
+        tail = collections.deque(maxlen=self.STREAM_TAIL_LINES)
+        with subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              bufsize=1, text=True) as process:
+            for line in process.stdout:
+                sys.stdout.write(line)
+                tail.append(line)
+                
+        output = ''.join(tail)
+        if process.returncode != 0:
+            # The output is already on screen, so only name the command
+            self.print_error(f"Command failed: {' '.join(command) if isinstance(command, list) else command}")
+            if check:
+                raise subprocess.CalledProcessError(process.returncode, command, output=output)
+        return subprocess.CompletedProcess(command, process.returncode, output, '')
+        
+    async def _run(self, command: List[str], check: bool = True,
+                   env: Optional[Dict[str, str]] = None,
+                   stream_prefix: Optional[str] = None) -> subprocess.CompletedProcess:
+        """Run a command without blocking the event loop and return the result.
+        
+        With stream_prefix set, the combined output is forwarded line by line with that
+        prefix (so concurrent commands stay readable) and only its last lines are kept.
+        """
+        if stream_prefix is None:
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=env
+            )
+            stdout, stderr = await process.communicate()
+            result = subprocess.CompletedProcess(command, process.returncode, stdout.decode(), stderr.decode())
+        else:
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=env,
+                limit=1024 * 1024
+            )
+            tail = collections.deque(maxlen=self.STREAM_TAIL_LINES)
+            async for raw_line in process.stdout:
+                line = raw_line.decode(errors='replace')
+                sys.stdout.write(stream_prefix + line)
+                tail.append(line)
+            await process.wait()
+            result = subprocess.CompletedProcess(command, process.returncode, ''.join(tail), '')
+            
+        if result.returncode != 0:
+            self.print_error(f"Command failed: {' '.join(command)}")
+            if stream_prefix is None:
+                self.print_error(f"Error: {result.stderr}")
+            if check:
+                raise subprocess.CalledProcessError(result.returncode, command, result.stdout, result.stderr)
+        return result
+        
     def command_exists(self, command: str) -> bool:
         """Check if a command exists in the system."""
-        try:
-            self.run_command(['which', command])
-            return True
-        except subprocess.CalledProcessError:
-            return False
+        return _which(command, os.environ.get('PATH')) is not None
             
+    def _download_installer(self, url: str) -> Path:
+        """Download an install script, reusing a recently cached copy on reruns."""
+        installers_dir = self.cache_dir / 'installers'
+        installers_dir.mkdir(parents=True, exist_ok=True)
+        script_path = installers_dir / f"{hashlib.sha256(url.encode()).hexdigest()}.sh"
+        
+        # Installers come from HEAD/master URLs, so don't reuse an old copy for long
+        if script_path.exists() and time.time() - script_path.stat().st_mtime > self.INSTALLER_MAX_AGE:
+            script_path.unlink()
+            
+        if not script_path.exists():
+            # Write to a temporary name first so an interrupted download is never reused
+            partial_path = script_path.with_suffix('.part')
+            try:
+                with urllib.request.urlopen(url, timeout=self.DOWNLOAD_TIMEOUT) as response:
+                    partial_path.write_bytes(response.read())
+            except (OSError, http.client.HTTPException) as e:
+                # Covers URLError, timeouts (socket.timeout on Python 3.9), resets and truncated
+                # bodies; Python builds without CA certificates also fail here, while curl uses
+                # the system store
+                self.print_warning(f"Download failed ({getattr(e, 'reason', e)}), retrying with curl...")
+                self.run_command([
+                    'curl', '-fsSL', '--max-time', str(self.DOWNLOAD_TIMEOUT), '-o', str(partial_path), url
+                ])
+            os.replace(partial_path, script_path)
+            
+        return script_path
+        
     def install_xcode_tools(self) -> None:
         """Install Xcode Command Line Tools."""
         self.print_step("Installing Xcode Command Line Tools")
@@ -89,74 +347,174 @@ class MacSetup:
             return
             
         self.print_warning("Installing Homebrew...")
-        install_script = '/bin/bash -c "$(curl -fsSL https://raw.githubusercontent.com/Homebrew/install/HEAD/install.sh)"'
-        self.run_command(install_script, shell=True)
+        install_script = self._download_installer('https://raw.githubusercontent.com/Homebrew/install/HEAD/install.sh')
+        self.run_command(['/bin/bash', str(install_script)], stream=True)
         
         # Add Homebrew to PATH for Apple Silicon Macs
         if os.path.exists("/opt/homebrew/bin/brew"):
             os.environ["PATH"] = f"/opt/homebrew/bin:{os.environ.get('PATH', '')}"
             
+        # The installer changed what's on disk, so look brew up afresh
+        _which_hits.clear()
+        if not self.command_exists('brew'):
+            self.print_error("Homebrew installed but brew is not on PATH")
+            self.print_warning("Add Homebrew to your PATH and run this script again")
+            sys.exit(1)
+            
         self.print_success("Homebrew installed")
         
-    def install_brew_packages(self) -> None:
-        """Install packages via Homebrew."""
+    @cached_step('brew-packages', "Installing Homebrew packages",
+                 inputs=lambda self: [self.CLI_TOOLS, self.CASK_APPS])
+    def install_brew_packages(self) -> bool:
+        """Install packages via Homebrew. Returns False if anything failed to install."""
         self.print_step("Installing Homebrew packages")
         
-        # CLI tools
-        cli_tools = [
-            'git', 'wget', 'gcc', 'python@3.12', 'node', 'npm'
-        ]
-        
-        # Applications
-        cask_apps = [
-            'visual-studio-code', 'firefox', 'ghostty', 'notion', 
-            'slack', '1password', 'docker', 'zoom',
-            'raycast', 'nikitabobko/tap/aerospace'
-        ]
+        if not self.command_exists('brew'):
+            self.print_error("Homebrew not found, skipping package installation")
+            return False
+            
+        # Fetch installed packages once instead of probing each one
+        self._load_installed_brew_packages()
         
-        self.print_warning("Installing CLI tools...")
-        for tool in cli_tools:
+        missing_formulae = []
+        for tool in self.CLI_TOOLS:
             if self._is_brew_package_installed(tool):
                 self.print_success(f"{tool} already installed")
             else:
-                self.print_warning(f"Installing {tool}...")
-                try:
-                    self.run_command(['brew', 'install', tool])
-                    self.print_success(f"{tool} installed")
-                except subprocess.CalledProcessError:
-                    self.print_error(f"Failed to install {tool}")
-                    
-        self.print_warning("Installing applications...")
-        for app in cask_apps:
+                missing_formulae.append(tool)
+                
+        missing_casks = []
+        for app in self.CASK_APPS:
             app_name = app.split('/')[-1]  # Get the actual app name
             if self._is_brew_cask_installed(app_name):
                 self.print_success(f"{app_name} already installed")
+            elif '/' in app:  # It's a tap, install as a formula
+                missing_formulae.append(app)
             else:
-                self.print_warning(f"Installing {app_name}...")
-                try:
-                    if '/' in app:  # It's a tap
-                        self.run_command(['brew', 'install', app])
-                    else:
-                        self.run_command(['brew', 'install', '--cask', app])
-                    self.print_success(f"{app_name} installed")
-                except subprocess.CalledProcessError:
-                    self.print_error(f"Failed to install {app}")
-                    
-    def _is_brew_package_installed(self, package: str) -> bool:
-        """Check if a Homebrew package is installed."""
+                missing_casks.append(app)
+                
+        all_installed = True
+        if missing_formulae:
+            self.print_warning(f"Installing CLI tools: {', '.join(missing_formulae)}...")
+            all_installed &= self._brew_install_batch(['brew', 'install'], missing_formulae)
+            
+        if missing_casks:
+            self.print_warning(f"Installing applications: {', '.join(missing_casks)}...")
+            all_installed &= asyncio.run(self._install_casks(missing_casks, self._sudo_ready))
+            
+        return all_installed
+        
+    async def _install_casks(self, casks: List[str], sudo_ready: Optional[bool]) -> bool:
+        """Install casks concurrently so their downloads overlap.
+        
+        Casks rarely share dependencies, so unlike formulae they don't contend on brew's
+        locks. sudo_ready comes from prepare_sudo_for_casks: if some cask needs sudo but no
+        password was cached, the casks are installed one at a time so their prompts can't
+        collide. Returns True if every cask installed.
+        """
+        workers = min(4, os.cpu_count() or 1) if sudo_ready is not False else 1
+        semaphore = asyncio.Semaphore(workers)
+        # A concurrent auto-update would race between the parallel brew processes
+        env = {**os.environ, 'HOMEBREW_NO_AUTO_UPDATE': '1'}
+        
+        async def install(cask: str) -> bool:
+            async with semaphore:
+                result = await self._run(['brew', 'install', '--cask', cask], check=False, env=env,
+                                         stream_prefix=f"[{cask}] ")
+            if result.returncode == 0:
+                self.print_success(f"{cask} installed")
+                return True
+            self.print_error(f"Failed to install {cask}")
+            return False
+            
+        results = await asyncio.gather(*[install(cask) for cask in casks])
+        return all(results)
+        
+    def _missing_casks(self) -> List[str]:
+        """List the casks (not tap formulae) that still need installing."""
+        return [
+            app for app in self.CASK_APPS
+            if '/' not in app and not self._is_brew_cask_installed(app)
+        ]
+        
+    def _casks_need_sudo(self, casks: List[str]) -> bool:
+        """Check whether any of the casks runs a pkg installer, which needs sudo."""
+        result = self.run_command(['brew', 'info', '--json=v2', '--cask', *casks], check=False)
         try:
-            self.run_command(['brew', 'list', package])
-            return True
-        except subprocess.CalledProcessError:
+            info = json.loads(result.stdout)
+        except ValueError:
+            return True  # Can't tell, so assume it does
+        return any(
+            'pkg' in artifact or 'installer' in artifact
+            for cask in info.get('casks', [])
+            for artifact in cask.get('artifacts', [])
+            if isinstance(artifact, dict)
+        )
+        
+    def prepare_sudo_for_casks(self) -> Optional[bool]:
+        """Ask for the sudo password before the concurrent steps if a missing cask needs it.
+        
+        Returns None when no sudo is needed, otherwise whether the password was cached.
+        The cached password is kept fresh in the background for the rest of the run.
+        """
+        casks = self._missing_casks()
+        if not casks or not self._casks_need_sudo(casks):
+            return None
+            
+        self.print_warning("Some applications need administrator rights to install")
+        if subprocess.run(['sudo', '-v']).returncode != 0:
             return False
             
-    def _is_brew_cask_installed(self, cask: str) -> bool:
-        """Check if a Homebrew cask is installed."""
+        threading.Thread(target=self._keep_sudo_alive, daemon=True).start()
+        return True
+        
+    def _keep_sudo_alive(self) -> None:
+        """Refresh the sudo timestamp every minute, so long installs don't prompt again."""
+        while True:
+            time.sleep(60)
+            subprocess.run(['sudo', '-n', '-v'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            
+    def _brew_install_batch(self, base_command: List[str], packages: List[str]) -> bool:
+        """Install several Homebrew packages in one call, retrying one by one on failure.
+        
+        Returns True if every package ended up installed.
+        """
         try:
-            self.run_command(['brew', 'list', '--cask', cask])
+            self.run_command(base_command + packages, stream=True)
+            for package in packages:
+                self.print_success(f"{package.split('/')[-1]} installed")
             return True
         except subprocess.CalledProcessError:
-            return False
+            self.print_warning("Batch install failed, retrying packages individually...")
+            
+        all_installed = True
+        for package in packages:
+            try:
+                self.run_command(base_command + [package], stream=True)
+                self.print_success(f"{package.split('/')[-1]} installed")
+            except subprocess.CalledProcessError:
+                self.print_error(f"Failed to install {package}")
+                all_installed = False
+        return all_installed
+                
+    def _load_installed_brew_packages(self) -> None:
+        """Fetch the installed Homebrew formulae and casks in two calls."""
+        if self._installed_formulae is None:
+            result = self.run_command(['brew', 'list', '--formula', '-1'], check=False)
+            self._installed_formulae = set(result.stdout.split()) if result.returncode == 0 else set()
+        if self._installed_casks is None:
+            result = self.run_command(['brew', 'list', '--cask', '-1'], check=False)
+            self._installed_casks = set(result.stdout.split()) if result.returncode == 0 else set()
+            
+    def _is_brew_package_installed(self, package: str) -> bool:
+        """Check if a Homebrew package is installed."""
+        self._load_installed_brew_packages()
+        return package in self._installed_formulae
+            
+    def _is_brew_cask_installed(self, cask: str) -> bool:
+        """Check if a Homebrew cask is installed."""
+        self._load_installed_brew_packages()
+        return cask in self._installed_casks
             
     def install_oh_my_zsh(self) -> None:
         """Install Oh My Zsh."""
@@ -168,45 +526,43 @@ class MacSetup:
             return
             
         self.print_warning("Installing Oh My Zsh...")
-        install_script = 'sh -c "$(curl -fsSL https://raw.github.com/ohmyzsh/ohmyzsh/master/tools/install.sh)" "" --unattended'
-        self.run_command(install_script, shell=True)
+        install_script = self._download_installer('https://raw.github.com/ohmyzsh/ohmyzsh/master/tools/install.sh')
+        self.run_command(['sh', str(install_script), '--unattended'], stream=True)
         self.print_success("Oh My Zsh installed")
         
-    def install_zsh_plugins(self) -> None:
+    @cached_step('zsh-plugins', "Installing Zsh plugins", inputs=lambda self: [
+        self.ZSH_PLUGINS, [(self.plugins_dir / name).exists() for name in self.ZSH_PLUGINS]
+    ])
+    async def install_zsh_plugins(self) -> None:
         """Install Zsh plugins."""
         self.print_step("Installing Zsh plugins")
         
-        plugins_dir = self.home / '.oh-my-zsh' / 'custom' / 'plugins'
-        plugins_dir.mkdir(parents=True, exist_ok=True)
+        self.plugins_dir.mkdir(parents=True, exist_ok=True)
         
-        plugins = {
-            'zsh-autosuggestions': 'https://github.com/zsh-users/zsh-autosuggestions',
-            'zsh-syntax-highlighting': 'https://github.com/zsh-users/zsh-syntax-highlighting',
-            'zsh-completions': 'https://github.com/zsh-users/zsh-completions'
-        }
+        await asyncio.gather(*[
+            self._clone_plugin(self.plugins_dir, plugin_name, plugin_url)
+            for plugin_name, plugin_url in self.ZSH_PLUGINS.items()
+        ])
         
-        for plugin_name, plugin_url in plugins.items():
-            plugin_path = plugins_dir / plugin_name
-            if plugin_path.exists():
-                self.print_success(f"{plugin_name} already installed")
-            else:
-                self.print_warning(f"Installing {plugin_name}...")
-                self.run_command(['git', 'clone', plugin_url, str(plugin_path)])
-                self.print_success(f"{plugin_name} installed")
+    async def _clone_plugin(self, plugins_dir: Path, plugin_name: str, plugin_url: str) -> None:
+        """Clone a single Zsh plugin unless it is already present."""
+        plugin_path = plugins_dir / plugin_name
+        if plugin_path.exists():
+            self.print_success(f"{plugin_name} already installed")
+        else:
+            self.print_warning(f"Installing {plugin_name}...")
+            await self._run([
+                'git', 'clone', '--depth', '1', '--single-branch', plugin_url, str(plugin_path)
+            ])
+            self.print_success(f"{plugin_name} installed")
                 
     def setup_git_config(self) -> None:
         """Setup Git configuration."""
         self.print_step("Setting up Git configuration")
         
-        git_name = input("Git user name: ").strip()
-        git_email = input("Git user email: ").strip()
+        git_name = self.config.get('git_name', '')
+        git_email = self.config.get('git_email', '')
         
-        if git_name:
-            self.run_command(['git', 'config', '--global', 'user.name', git_name])
-            
-        if git_email:
-            self.run_command(['git', 'config', '--global', 'user.email', git_email])
-            
         # Set useful defaults
         git_configs = [
             ['init.defaultBranch', 'main'],
@@ -215,6 +571,14 @@ class MacSetup:
             ['core.editor', 'code --wait']
         ]
         
+        if git_name:
+            git_configs.append(['user.name', git_name])
+            
+        if git_email:
+            git_configs.append(['user.email', git_email])
+            
+        # git handles quoting and keeps comments, multi-valued keys and the file mode; it
+        # also replaces the file via a lock, so a hardlinked repo copy is untouched
         for config_key, config_value in git_configs:
             self.run_command(['git', 'config', '--global', config_key, config_value])
             
@@ -224,139 +588,215 @@ class MacSetup:
         """Setup SSH keys."""
         self.print_step("Setting up SSH keys")
         
-        ssh_key_path = self.home / '.ssh' / 'id_ed25519'
+        ssh_key_path = self.ssh_key_path
         if ssh_key_path.exists():
             self.print_success("SSH key already exists")
-            print("Public key:")
-            with open(f"{ssh_key_path}.pub", 'r') as f:
-                print(f.read().strip())
         else:
-            ssh_email = input("Enter email for SSH key: ").strip()
-            if ssh_email:
-                self.run_command([
-                    'ssh-keygen', '-t', 'ed25519', '-C', ssh_email,
-                    '-f', str(ssh_key_path), '-N', ''
-                ])
+            ssh_email = self.config.get('ssh_email', '')
+            if not ssh_email:
+                self.print_warning("No SSH email given, skipping key generation")
+                return
                 
-                # Add to ssh-agent
-                self.run_command('eval "$(ssh-agent -s)"', shell=True)
-                self.run_command(['ssh-add', str(ssh_key_path)])
-                
-                self.print_success("SSH key generated")
-                print("Public key:")
-                with open(f"{ssh_key_path}.pub", 'r') as f:
-                    print(f.read().strip())
+            self.run_command([
+                'ssh-keygen', '-t', 'ed25519', '-C', ssh_email,
+                '-f', str(ssh_key_path), '-N', ''
+            ])
+            
+            # Add to ssh-agent
+            self._start_ssh_agent()
+            self.run_command(['ssh-add', str(ssh_key_path)])
+            
+            self.print_success("SSH key generated")
+            
+        # Printed after the concurrent steps, so it isn't buried in their output
+        self._public_key = ssh_key_path.with_suffix('.pub').read_text().strip()
+        
+    def _start_ssh_agent(self) -> None:
+        """Start ssh-agent unless one is already running, exporting its variables to os.environ."""
+        if 'SSH_AUTH_SOCK' in os.environ:
+            return
+        result = self.run_command(['ssh-agent', '-s'])
+        # Output looks like: SSH_AUTH_SOCK=/tmp/...; export SSH_AUTH_SOCK;
+        for name, value in re.findall(r'(SSH_AUTH_SOCK|SSH_AGENT_PID)=([^;]+);', result.stdout):
+            os.environ[name] = value
+            
+    def _print_public_key(self) -> None:
+        """Print the SSH public key found or generated by setup_ssh_keys."""
+        if self._public_key:
+            print("\nPublic key:")
+            print(self._public_key)
                     
+    @cached_step('caps-lock-to-escape', "Mapping Caps Lock to Escape",
+                 inputs=lambda self: self.key_remapping_plist.exists())
     def setup_caps_lock_to_escape(self) -> None:
         """Map Caps Lock to Escape."""
         self.print_step("Mapping Caps Lock to Escape")
         
         # Set the mapping
-        hidutil_command = 'hidutil property --set \'{"UserKeyMapping":[{"HIDKeyboardModifierMappingSrc":0x700000039,"HIDKeyboardModifierMappingDst":0x700000029}]}\''
-        self.run_command(hidutil_command, shell=True)
+        self.run_command(['hidutil', 'property', '--set', json.dumps(self.CAPS_LOCK_TO_ESCAPE)])
         
         # Make it persistent
-        launch_agents_dir = self.home / 'Library' / 'LaunchAgents'
-        launch_agents_dir.mkdir(parents=True, exist_ok=True)
-        
-        plist_content = '''<?xml version="1.0" encoding="UTF-8"?>
-<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
-<plist version="1.0">
-<dict>
-    <key>Label</key>
-    <string>com.local.KeyRemapping</string>
-    <key>ProgramArguments</key>
-    <array>
-        <string>/usr/bin/hidutil</string>
-        <string>property</string>
-        <string>--set</string>
-        <string>{"UserKeyMapping":[{"HIDKeyboardModifierMappingSrc":0x700000039,"HIDKeyboardModifierMappingDst":0x700000029}]}</string>
-    </array>
-    <key>RunAtLoad</key>
-    <true/>
-</dict>
-</plist>'''
-        
-        plist_path = launch_agents_dir / 'com.local.KeyRemapping.plist'
-        with open(plist_path, 'w') as f:
-            f.write(plist_content)
+        self.key_remapping_plist.parent.mkdir(parents=True, exist_ok=True)
+        
+        plist = {
+            'Label': 'com.local.KeyRemapping',
+            'ProgramArguments': [
+                '/usr/bin/hidutil', 'property', '--set', json.dumps(self.CAPS_LOCK_TO_ESCAPE)
+            ],
+            'RunAtLoad': True
+        }
+        
+        plist_path = self.key_remapping_plist
+        with open(plist_path, 'wb') as f:
+            plistlib.dump(plist, f, fmt=plistlib.FMT_BINARY)
             
         self.run_command(['launchctl', 'load', str(plist_path)])
         self.print_success("Caps Lock mapped to Escape (persistent)")
         
+    @cached_step('dock', "Configuring macOS Dock", inputs=lambda self: [
+        self.DOCK_APPS, [Path(app_path).exists() for app_path in self.DOCK_APPS]
+    ])
     def setup_dock(self) -> None:
         """Configure the macOS Dock with specific applications."""
         self.print_step("Configuring macOS Dock")
         
-        # Clear the Dock first
-        self.print_warning("Clearing current Dock...")
-        self.run_command(['defaults', 'write', 'com.apple.dock', 'persistent-apps', '-array'])
-        
-        # Applications to add to Dock (in order)
-        dock_apps = [
-            '/Applications/Visual Studio Code.app',
-            '/Applications/Slack.app', 
-            '/Applications/Firefox.app'
-        ]
-        
         self.print_warning("Adding applications to Dock...")
-        for app_path in dock_apps:
+        persistent_apps = []
+        for app_path in self.DOCK_APPS:
             if Path(app_path).exists():
-                # Add app to Dock
-                self.run_command([
-                    'defaults', 'write', 'com.apple.dock', 'persistent-apps', '-array-add',
-                    f'<dict><key>tile-data</key><dict><key>file-data</key><dict><key>_CFURLString</key><string>{app_path}</string><key>_CFURLStringType</key><integer>0</integer></dict></dict></dict>'
-                ])
+                persistent_apps.append({
+                    'tile-data': {
+                        'file-data': {'_CFURLString': app_path, '_CFURLStringType': 0}
+                    }
+                })
                 self.print_success(f"Added {Path(app_path).stem} to Dock")
             else:
                 self.print_warning(f"{Path(app_path).stem} not found at {app_path}")
         
         # Configure Dock settings
-        dock_settings = [
-            ('autohide', 'false'),  # Don't auto-hide dock
-            ('magnification', 'false'),  # Disable magnification
-            ('tilesize', '48'),  # Set icon size
-            ('show-recents', 'false'),  # Don't show recent apps
-            ('mineffect', 'scale')  # Minimize effect
-        ]
+        dock_settings = {
+            'autohide': False,  # Don't auto-hide dock
+            'magnification': False,  # Disable magnification
+            'tilesize': 48,  # Set icon size
+            'show-recents': False,  # Don't show recent apps
+            'mineffect': 'scale'  # Minimize effect
+        }
         
         self.print_warning("Configuring Dock settings...")
-        for setting, value in dock_settings:
-            self.run_command(['defaults', 'write', 'com.apple.dock', setting, value])
+        
+        # 'defaults import' replaces the whole domain, so only use it when the current
+        # Dock preferences could be read and merged; otherwise write key by key
+        result = self.run_command(['defaults', 'export', 'com.apple.dock', '-'], check=False)
+        dock_prefs = None
+        if result.returncode == 0:
+            try:
+                dock_prefs = plistlib.loads(result.stdout.encode())
+            except (plistlib.InvalidFileException, xml.parsers.expat.ExpatError):
+                pass
+                
+        if isinstance(dock_prefs, dict):
+            # Replaces the current Dock apps
+            dock_prefs['persistent-apps'] = persistent_apps
+            dock_prefs.update(dock_settings)
+            with tempfile.NamedTemporaryFile(suffix='.plist') as f:
+                plistlib.dump(dock_prefs, f)
+                f.flush()
+                self.run_command(['defaults', 'import', 'com.apple.dock', f.name])
+        else:
+            self.print_warning("Could not read current Dock preferences, writing settings one by one")
+            self._write_dock_defaults(persistent_apps, dock_settings)
             
-        # Restart Dock to apply changes
-        self.run_command(['killall', 'Dock'])
+        # Restart Dock to apply changes once all steps are done
+        self._pending_restarts.add('Dock')
         self.print_success("Dock configured with VS Code, Slack, and Firefox")
         
+    def _write_dock_defaults(self, persistent_apps: List[Dict[str, Any]], dock_settings: Dict[str, Any]) -> None:
+        """Write Dock apps and settings with one 'defaults write' per key."""
+        self.run_command(['defaults', 'write', 'com.apple.dock', 'persistent-apps', '-array'])
+        for tile in persistent_apps:
+            app_path = xml.sax.saxutils.escape(tile['tile-data']['file-data']['_CFURLString'])
+            self.run_command([
+                'defaults', 'write', 'com.apple.dock', 'persistent-apps', '-array-add',
+                f'<dict><key>tile-data</key><dict><key>file-data</key><dict><key>_CFURLString</key><string>{app_path}</string><key>_CFURLStringType</key><integer>0</integer></dict></dict></dict>'
+            ])
+            
+        for setting, value in dock_settings.items():
+            if isinstance(value, bool):
+                typed_value = ['-bool', 'true' if value else 'false']
+            elif isinstance(value, int):
+                typed_value = ['-int', str(value)]
+            else:
+                typed_value = ['-string', str(value)]
+            self.run_command(['defaults', 'write', 'com.apple.dock', setting, *typed_value])
+            
+    def _find_dotfiles(self, warn_untracked: bool = False) -> List[Path]:
+        """List the dotfiles (hidden regular files) in the dotfiles directory.
+        
+        Only files tracked by git are used when the repo is a git checkout, so stray
+        files such as Finder's .DS_Store are never linked into the home directory.
+        """
+        if not self.dotfiles_dir.exists():
+            return []
+            
+        result = self.run_command(['git', '-C', str(self.dotfiles_dir), 'ls-files', '-z', '.'], check=False)
+        tracked = set(result.stdout.split('\0')) if result.returncode == 0 else None
+        
+        dotfiles = []
+        for path in sorted(self.dotfiles_dir.iterdir()):
+            if not path.name.startswith('.') or not path.is_file() or path.name in self.IGNORED_DOTFILES:
+                continue
+            if tracked is not None and path.name not in tracked:
+                if warn_untracked:
+                    self.print_warning(f"Skipping {path.name}: not tracked by git (commit it to install it)")
+                continue
+            dotfiles.append(path)
+        return dotfiles
+        
+    @cached_step('dotfiles', "Copying dotfiles", inputs=lambda self: {
+        source.name: source.stat().st_mtime for source in self._find_dotfiles()
+    })
     def copy_dotfiles(self) -> None:
-        """Copy dotfiles from the dotfiles directory to home directory."""
-        self.print_step("Copying dotfiles")
+        """Link (or copy) dotfiles from the dotfiles directory to home directory.
         
-        script_dir = Path(__file__).parent
-        dotfiles_dir = script_dir / 'dotfiles'
+        Files are hardlinked when the repo and home directory share a filesystem, which
+        keeps them in sync with the repo; otherwise they are copied.
+        """
+        self.print_step("Copying dotfiles")
         
-        if not dotfiles_dir.exists():
+        if not self.dotfiles_dir.exists():
             self.print_error("dotfiles directory not found")
             return
             
-        dotfiles = ['.zshrc', '.gitconfig', '.aerospace.toml']
+        same_device = self.dotfiles_dir.stat().st_dev == self.home.stat().st_dev
         
-        for dotfile in dotfiles:
-            source = dotfiles_dir / dotfile
+        for source in self._find_dotfiles(warn_untracked=True):
+            dotfile = source.name
             target = self.home / dotfile
             
-            if source.exists():
+            # A dangling symlink (e.g. left over from stow) doesn't "exist" but still blocks os.link
+            if target.exists() or target.is_symlink():
+                if target.exists() and target.samefile(source):
+                    self.print_success(f"{dotfile} already linked")
+                    continue
+                    
+                # Cheap size check first, only compare contents when sizes match
+                if (target.exists()
+                        and target.stat().st_size == source.stat().st_size
+                        and filecmp.cmp(source, target, shallow=False)):
+                    self.print_success(f"{dotfile} unchanged")
+                    continue
+                    
                 # Backup existing file
-                if target.exists():
-                    backup = self.home / f"{dotfile}.backup"
-                    target.rename(backup)
-                    self.print_warning(f"Backed up existing {dotfile} to {dotfile}.backup")
+                backup = self.home / f"{dotfile}.backup"
+                os.replace(target, backup)
+                self.print_warning(f"Backed up existing {dotfile} to {dotfile}.backup")
                 
-                # Copy the dotfile
-                shutil.copy2(source, target)
-                self.print_success(f"Copied {dotfile}")
+            if same_device:
+                os.link(source, target)
+                self.print_success(f"Linked {dotfile}")
             else:
-                self.print_warning(f"{dotfile} not found in dotfiles directory")
+                shutil.copyfile(source, target)
+                self.print_success(f"Copied {dotfile}")
                 
     def setup_vscode_settings_sync(self) -> None:
         """Setup VS Code and prompt for Settings Sync."""
@@ -410,6 +850,47 @@ class MacSetup:
             self.print_warning("Please open VS Code and run 'Shell Command: Install code command in PATH'")
             self.print_warning("Or add VS Code to your PATH manually")
             
+    def _restart_pending_services(self) -> None:
+        """Restart the services (Dock, Finder, ...) whose preferences changed, once each."""
+        for service in sorted(self._pending_restarts):
+            self.run_command(['killall', service], check=False)
+        self._pending_restarts.clear()
+        
+    def collect_config(self) -> None:
+        """Prompt once, up front, for any settings not given on the command line or config file."""
+        prompts = [
+            ('git_name', "Git user name: "),
+            ('git_email', "Git user email: "),
+        ]
+        if not self.ssh_key_path.exists():
+            prompts.append(('ssh_email', "Enter email for SSH key: "))
+            
+        for key, prompt in prompts:
+            if key not in self.config:
+                self.config[key] = input(prompt).strip()
+                
+    async def _dotfiles_setup(self) -> None:
+        """Install dotfiles, then merge the Git settings into the copied .gitconfig."""
+        await asyncio.to_thread(self.copy_dotfiles)
+        await asyncio.to_thread(self.setup_git_config)
+        
+    async def _shell_setup(self) -> None:
+        """Install Oh My Zsh, then its plugins and the dotfiles that override its .zshrc."""
+        await asyncio.to_thread(self.install_oh_my_zsh)
+        await asyncio.gather(
+            self.install_zsh_plugins(),
+            self._dotfiles_setup(),
+        )
+        
+    async def _run_independent_steps(self) -> None:
+        """Run the steps that only depend on Homebrew concurrently."""
+        await asyncio.gather(
+            asyncio.to_thread(self.install_brew_packages),
+            self._shell_setup(),
+            asyncio.to_thread(self.setup_ssh_keys),
+            asyncio.to_thread(self.setup_caps_lock_to_escape),
+        )
+        
     def run_setup(self) -> None:
         """Run the complete setup process."""
         print(f"{Colors.BLUE}")
@@ -418,23 +899,26 @@ class MacSetup:
         print(f"{Colors.NC}")
         
         print("This script will set up your Mac with development tools and configurations.")
-        response = input("Continue? (y/N): ").strip().lower()
-        
-        if response not in ['y', 'yes']:
-            print("Setup cancelled.")
-            return
+        if not self.config.get('yes'):
+            response = input("Continue? (y/N): ").strip().lower()
+            
+            if response not in ['y', 'yes']:
+                print("Setup cancelled.")
+                return
             
         try:
+            # All input is gathered here so the steps below never block on stdin
+            self.collect_config()
+            
             # Run setup steps
             self.install_xcode_tools()
             self.install_homebrew()
-            self.install_brew_packages()
-            self.install_oh_my_zsh()
-            self.install_zsh_plugins()
-            self.copy_dotfiles()
-            self.setup_git_config()
-            self.setup_ssh_keys()
-            self.setup_caps_lock_to_escape()
+            # Ask for the sudo password now, not in the middle of the concurrent steps
+            self._sudo_ready = self.prepare_sudo_for_casks()
+            asyncio.run(self._run_independent_steps())
+            self._print_public_key()
+            
+            # These need the installed apps
             self.setup_dock()
             self.setup_vscode_command_line()
             self.setup_vscode_settings_sync()
@@ -454,15 +938,62 @@ class MacSetup:
         except Exception as e:
             print(f"\n{Colors.RED}Setup failed: {e}{Colors.NC}")
             raise
+        finally:
+            # Apply changes made by earlier steps even if a later one failed
+            self._restart_pending_services()
+
+
+DEFAULT_CONFIG_PATH = Path.home() / '.config' / 'mac-setup.toml'
+
+
+def load_config(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Build the setup config from a TOML file overlaid with command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--git-name', help="Git user name")
+    parser.add_argument('--git-email', help="Git user email")
+    parser.add_argument('--ssh-email', help="Email for a new SSH key")
+    parser.add_argument('-y', '--yes', action='store_true', help="Don't ask for confirmation")
+    parser.add_argument('--config', type=Path,
+                        help=f"TOML file with the settings above (default: {DEFAULT_CONFIG_PATH})")
+    args = parser.parse_args(argv)
+    
+    config: Dict[str, Any] = {}
+    config_path = args.config or DEFAULT_CONFIG_PATH
+    if args.config or config_path.exists():
+        if tomllib is None:
+            parser.error("reading a config file requires Python 3.11+")
+        try:
+            with open(config_path, 'rb') as f:
+                config.update(tomllib.load(f))
+        except (OSError, tomllib.TOMLDecodeError) as e:
+            parser.error(f"could not read {config_path}: {e}")
+        for key in ('git_name', 'git_email', 'ssh_email'):
+            if key in config and not isinstance(config[key], str):
+                parser.error(f"{config_path}: {key} must be a string")
+        if 'yes' in config and not isinstance(config['yes'], bool):
+            parser.error(f"{config_path}: yes must be true or false")
+            
+    # Command line values win over the config file
+    for key in ('git_name', 'git_email', 'ssh_email'):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    if args.yes:
+        config['yes'] = True
+    return config
 
 
 def main():
     """Main function."""
+    config = load_config()
+    
     if sys.platform != 'darwin':
         print("This script is designed for macOS only.")
         sys.exit(1)
         
-    setup = MacSetup()
+    if not sys.stdout.isatty():
+        Colors.disable()
+        
+    setup = MacSetup(config)
     setup.run_setup()
 
 